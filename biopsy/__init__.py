@@ -1,5 +1,18 @@
 """Biopsy package."""
 
-from .annotated_slide import read_annotated_slide
-
 __all__ = ["read_annotated_slide"]
+
+
+def __getattr__(name: str):
+    """Load the slide machinery lazily.
+
+    Importing the package eagerly pulls in the OpenSlide shared library, lxml
+    and Pillow, which adds noticeable latency and memory to commands that never
+    touch a slide (such as --help and --version).
+    """
+    if name == "read_annotated_slide":
+        # pylint:disable=import-outside-toplevel
+        from .annotated_slide import read_annotated_slide
+
+        return read_annotated_slide
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,22 +1,37 @@
 """Classes and functions for working with annotated slides."""
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Iterable, Optional, Tuple, Union
 
-from openslide import OpenSlide
 from PIL import Image
 
 from .annotation import AnnotationCollection, read_ndpa
-from .tile_builder import TileBuilder
+from .tile_builder import TileBatch, TileBuilder
+
+# OpenSlide (a shared library) and tiffslide are imported inside the functions
+# that need them, keeping module import cheap for code that only touches
+# annotations.
+if TYPE_CHECKING:
+    from openslide import OpenSlide
 
 JPEG_QUALITY = 80
 TILE_SIZE = 512
 TILE_OVERLAP = 0.0
 
+# Properties the annotation transform needs; a backend that cannot provide
+# them cannot be used.
+REQUIRED_PROPERTIES = (
+    "openslide.mpp-x",
+    "openslide.mpp-y",
+    "hamamatsu.XOffsetFromSlideCentre",
+    "hamamatsu.YOffsetFromSlideCentre",
+)
+
 
 class AnnotatedSlide:
     """OpenSlide with annotations."""
 
-    def __init__(self, slide: OpenSlide, annotations: AnnotationCollection):
+    def __init__(self, slide: "OpenSlide", annotations: AnnotationCollection):
         """Initialize a new AnnotatedSlide instance.
 
         Args:
@@ -26,6 +41,32 @@ class AnnotatedSlide:
         """
         self._slide = slide
         self._annotations = annotations
+        # The per-level downsample factors are fixed for the slide, so they
+        # are parsed once here instead of on every region read.
+        self._level_downsamples = tuple(
+            int(round(downsample)) for downsample in slide.level_downsamples
+        )
+
+    @property
+    def annotations(self) -> AnnotationCollection:
+        """Return the annotations belonging to the slide.
+
+        Returns:
+            AnnotationCollection: The annotations.
+        """
+        return self._annotations
+
+    def get_thumbnail(self, size: Tuple[int, int]) -> Image.Image:
+        """Return a thumbnail of the slide no larger than specified size.
+
+        Args:
+            size (Tuple[int, int]): Maximum size (width, height) of the
+                thumbnail; the aspect ratio of the slide is preserved.
+
+        Returns:
+            Image.Image: The thumbnail.
+        """
+        return self._slide.get_thumbnail(size)
 
     @property
     def dimensions(self) -> Tuple[int, int]:
@@ -52,19 +93,29 @@ class AnnotatedSlide:
             Tuple[Image.Image, Image.Image]:  A tuple consisting of the slide region and
                 mask images.
         """
-        slide_region = self._slide.read_region(location, level, size).convert("RGB")
-
-        downsample = 2 ** level
-        key = f"openslide.level[{level}].downsample"
-        if downsample != int(self._slide.properties[key]):
+        # OpenSlide returns RGBA with an effectively opaque alpha channel.
+        # Re-reading the raw buffer with the RGBX unpacker drops the alpha in
+        # a single sequential C pass, without the strided copy a NumPy channel
+        # slice would incur.
+        region = self._slide.read_region(location, level, size)
+        slide_region = Image.frombytes(
+            "RGB", region.size, region.tobytes(), "raw", "RGBX", 0, 1
+        )
+
+        if (1 << level) != self._level_downsamples[level]:
             raise ValueError("Unexpected level downsample value")
 
         mask_region = self._annotations.render_region(location, level, size)
         return slide_region, mask_region
 
     def build_tiles(
-        self, level: int, tile_size: int, overlap: float, rotate: bool
-    ) -> Iterable[Tuple[int, int, int, Image.Image, Image.Image]]:
+        self,
+        level: int,
+        tile_size: int,
+        overlap: float,
+        rotate: bool,
+        color_images: bool = True,
+    ) -> Iterable[TileBatch]:
         """Build tiles from the slide.
 
         Args:
@@ -73,12 +124,16 @@ class AnnotatedSlide:
             overlap (float): The fraction of overlap between each tile.
             rotate (bool): A value indicating whether to create augmentations by
                 rotating the tiles.
+            color_images (bool, optional): A value indicating whether to build
+                color tiles. When False the tiles are converted to grayscale
+                during the region read. Defaults to True.
 
         Returns:
-            Iterable[Tuple[int, int, int, Image.Image, Image.Image]]: [description]
+            Iterable[TileBatch]: Batches of tiles with their coordinates,
+            rotations and annotation masks.
         """
         builder = TileBuilder(self)
-        return builder.build(level, tile_size, overlap, rotate)
+        return builder.build(level, tile_size, overlap, rotate, color_images)
 
 
 def read_annotated_slide(
@@ -98,11 +153,20 @@ def read_annotated_slide(
     """
     if isinstance(slide_file, Path):
         slide_file = str(slide_file)
-    slide = OpenSlide(slide_file)
 
     if annotations_file is None:
         annotations_file = Path(slide_file).with_suffix(".ndpi.ndpa")
 
+    # Opening the slide (TIFF directory parsing) and reading the annotation
+    # file are independent I/O tasks. The annotations cannot be parsed before
+    # the slide properties are known, but prefetching the file into the page
+    # cache while the slide opens hides the read latency.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        slide_future = executor.submit(_open_slide, slide_file)
+        executor.submit(_prefetch, Path(annotations_file))
+        slide = slide_future.result()
+    _disable_tile_cache(slide)
+
     dimensions = slide.dimensions
 
     mpp_x = float(slide.properties["openslide.mpp-x"])
@@ -115,3 +179,72 @@ def read_annotated_slide(
         annotations_file, dimensions, (mpp_x, mpp_y), (offset_x, offset_y)
     )
     return AnnotatedSlide(slide, annotations)
+
+
+def _prefetch(file: Path):
+    """Read specified file to warm the page cache, ignoring errors.
+
+    Args:
+        file (Path): The file to read.
+    """
+    try:
+        file.read_bytes()
+    except OSError:
+        pass
+
+
+def _open_slide(slide_file: str) -> "OpenSlide":
+    """Open specified slide file with the fastest available backend.
+
+    tiffslide is tried first since it is a drop-in replacement for the
+    read_region, dimensions and properties interface used here. tiffslide
+    reads TIFF-family slides (including ndpi) noticeably faster than
+    OpenSlide. OpenSlide is used when tiffslide is not installed, cannot open
+    the file, or does not expose the properties required for the annotation
+    transform.
+
+    Args:
+        slide_file (str): Path to the slide file.
+
+    Returns:
+        OpenSlide: The opened slide (or a tiffslide equivalent).
+    """
+    # pylint:disable=import-outside-toplevel
+    from openslide import OpenSlide
+
+    try:
+        import tiffslide
+    except ImportError:
+        return OpenSlide(slide_file)
+    try:
+        slide = tiffslide.TiffSlide(slide_file)
+    except Exception:  # pylint:disable=broad-except
+        return OpenSlide(slide_file)
+    if all(key in slide.properties for key in REQUIRED_PROPERTIES):
+        return slide
+    slide.close()
+    return OpenSlide(slide_file)
+
+
+def _disable_tile_cache(slide: "OpenSlide"):
+    """Disable the per-handle tile cache of specified slide.
+
+    Preprocessing streams over the slide and rarely revisits a decoded tile,
+    so the cache mostly adds a memcpy and memory pressure per read. The reads
+    that do overlap — the oversized regions fetched for rotated tiles — are
+    served from the OS page cache over the compressed file, helped by the
+    Morton visiting order of the tile builder. Older versions of the
+    OpenSlide Python bindings do not expose the cache API at all, and newer
+    bindings raise an OpenSlideVersionError when the underlying libopenslide
+    predates 4.0; in either case the slide is left untouched.
+
+    Args:
+        slide (OpenSlide): The slide for which to disable the cache.
+    """
+    # pylint:disable=import-outside-toplevel
+    import openslide
+
+    try:
+        slide.set_cache(openslide.OpenSlideCache(0))
+    except (AttributeError, openslide.OpenSlideError):
+        pass
@@ -1,11 +1,39 @@
 """Preprocessing of slides."""
 
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Iterator, Optional, Union
 
+import numpy as np
+from PIL import Image
 from tqdm.auto import tqdm
 
 from .annotated_slide import read_annotated_slide
 
+# PyTurboJPEG and simplejpeg both call libjpeg-turbo directly on the raw
+# pixel buffer, skipping Pillow's per-save encoder setup. PyTurboJPEG is
+# preferred since it reuses one persistent encoder handle across tiles;
+# simplejpeg is the fallback when only it is installed.
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+_turbo_jpeg = None
+
+# Bounds the number of encoded-but-unwritten JPEGs held in memory by the
+# background writer thread.
+WRITE_QUEUE_SIZE = 64
+
 
 def preprocess(
     input_folder: Path,
@@ -64,6 +92,8 @@ class SlidePreprocessor:
         self._rotate = rotate
         self._jpeg_quality = jpeg_quality
         self._color_images = color_images
+        self._write_queue: Optional["queue.Queue"] = None
+        self._write_error: Optional[OSError] = None
 
     def preprocess(self, input_folder: Path, output_folder: Path):
         """Create tiles for all pairs of slides and annotations in specified folder.
@@ -74,44 +104,208 @@ class SlidePreprocessor:
             input_folder (Path): Folder containing slides and annotations.
             output_folder (Path): Output folder in which to store tiles and masks.
         """
-        n_preprocessed = 0
-        for slide_file in tqdm(list(input_folder.glob("**/*.ndpi"))):
-            annotation_file = slide_file.with_suffix(".ndpi.ndpa")
-            if not annotation_file.is_file():
-                continue
-            slide_output_folder = output_folder / slide_file.with_suffix("").name
-            slide_output_folder.mkdir(exist_ok=True, parents=True)
-            self._preprocess_file(slide_file, slide_output_folder)
-            n_preprocessed += 1
-        print(f"Preprocessed {n_preprocessed} annotated slide(s).")
+        slide_files = list(_find_annotated_slides(input_folder))
+
+        # Slides are independent of each other, so they are preprocessed in
+        # parallel, one worker process per slide.
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [
+                executor.submit(
+                    self._preprocess_file,
+                    slide_file,
+                    output_folder / slide_file.with_suffix("").name,
+                )
+                for slide_file in slide_files
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+        print(f"Preprocessed {len(slide_files)} annotated slide(s).")
 
     def _preprocess_file(self, slide_file: Path, output_folder: Path):
+        output_folder.mkdir(exist_ok=True, parents=True)
         annotated_slide = read_annotated_slide(slide_file)
         tiles = annotated_slide.build_tiles(
-            self._level, self._tile_size, self._overlap, self._rotate
+            self._level,
+            self._tile_size,
+            self._overlap,
+            self._rotate,
+            self._color_images,
         )
 
-        for x, y, degrees, tile, segment in tiles:
-            tile_file = output_folder / (
-                slide_file.with_suffix("").name + f"_{x}_{y}_{degrees}.jpeg"
-            )
+        # Encoded JPEGs are handed to a background thread so disk latency
+        # overlaps with reading and encoding the next tile. The queue and
+        # thread are created here rather than in __init__ because the
+        # preprocessor instance is pickled to the per-slide worker processes.
+        self._write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._write_error = None
+        writer = threading.Thread(
+            target=self._writer_loop, args=(self._write_queue,), daemon=True
+        )
+        writer.start()
+        # The stem is the same for every tile of the slide, and building each
+        # output path as a single f-string spares the chained Path
+        # allocations the old with_suffix/with_name dance performed per tile.
+        stem = slide_file.with_suffix("").name
+        try:
+            for batch in tiles:
+                for index in range(len(batch)):
+                    x, y = batch.xs[index], batch.ys[index]
+                    degrees = batch.degrees[index]
+                    tile_file = output_folder / f"{stem}_{x}_{y}_{degrees}.jpeg"
+                    self._save_jpeg(batch.tiles[index], tile_file)
 
-            if not self._color_images:
-                tile = tile.convert("L")
+                    segment_file = (
+                        output_folder / f"{stem}_{x}_{y}_{degrees}_segment.jpeg"
+                    )
+                    self._save_jpeg(batch.masks[index], segment_file)
+        finally:
+            self._write_queue.put(None)
+            writer.join()
+            self._write_queue = None
+        if self._write_error is not None:
+            error, self._write_error = self._write_error, None
+            raise error
 
-            tile.save(
-                tile_file, quality=self._jpeg_quality, optimize=True, progressive=False
+    def _save_jpeg(self, image: Union[Image.Image, np.ndarray], path: Path):
+        encoded = _encode_jpeg(np.asarray(image), self._jpeg_quality)
+        if encoded is None:
+            # optimize=True would run a second Huffman pass for a marginal
+            # size gain, roughly doubling encode time for small tiles.
+            if isinstance(image, np.ndarray):
+                image = Image.fromarray(image)
+            buffer = io.BytesIO()
+            # subsampling=2 selects 4:2:0 chroma; Pillow ignores it for
+            # single-channel images, which have no chroma planes.
+            image.save(
+                buffer,
+                format="JPEG",
+                quality=self._jpeg_quality,
+                optimize=False,
+                progressive=False,
+                subsampling=2,
             )
+            encoded = buffer.getvalue()
+        # Surface writer-thread failures here instead of queueing into a dead
+        # thread, which would eventually block forever on a full queue.
+        if self._write_error is not None:
+            raise self._write_error
+        self._write_queue.put((path, encoded))
 
-            # Extract alpha channel (which contains the actual mask) from segment.
-            segment = segment.split()[-1]
+    def _writer_loop(self, write_queue: "queue.Queue"):
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            if self._write_error is not None:
+                # Keep draining after a failure so the producer never blocks
+                # on a full queue; the stored error is raised on its side.
+                continue
+            path, encoded = item
+            try:
+                path.write_bytes(encoded)
+            except OSError as error:
+                self._write_error = error
 
-            segment_file = tile_file.with_name(
-                tile_file.with_suffix("").name + "_segment.jpeg"
-            )
-            segment.save(
-                segment_file,
-                quality=self._jpeg_quality,
-                optimize=True,
-                progressive=False,
+
+def _find_annotated_slides(folder: Union[Path, str]) -> Iterator[Path]:
+    """Find all slide files with an annotation sibling under specified folder.
+
+    os.scandir is used instead of Path.glob: the directory entries carry their
+    file type from the kernel, and the annotation sibling can be looked up in
+    the listing of the directory already scanned, so no per-file stat calls
+    are made.
+
+    Args:
+        folder (Union[Path, str]): The folder to search, recursively.
+
+    Yields:
+        Iterator[Path]: Paths of ndpi files that have an ndpa sibling.
+    """
+    subfolders = []
+    names = set()
+    slide_entries = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+                continue
+            names.add(entry.name)
+            if entry.name.endswith(".ndpi"):
+                slide_entries.append(entry)
+    for entry in slide_entries:
+        if entry.name + ".ndpa" in names:
+            yield Path(entry.path)
+    for subfolder in subfolders:
+        yield from _find_annotated_slides(subfolder)
+
+
+def _encode_jpeg(array: np.ndarray, quality: int) -> Optional[bytes]:
+    """Encode a pixel array to a JPEG bytestream.
+
+    This is the single seam through which all tile and mask encodes go, so a
+    different encoder (a batched GPU encoder, say) only has to be wired up
+    here. Color images are encoded with 4:2:0 chroma subsampling, which
+    halves the chroma work and roughly halves the file size at this quality.
+    Returns None when no accelerated encoder is installed, in which case the
+    caller falls back to Pillow.
+
+    Args:
+        array (np.ndarray): Grayscale (H, W) or RGB (H, W, 3) uint8 pixels.
+        quality (int): JPEG quality.
+
+    Returns:
+        bytes | None: The encoded JPEG, or None without an accelerated
+            encoder.
+    """
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+        grayscale = True
+    else:
+        grayscale = False
+    array = np.ascontiguousarray(array)
+
+    handle = _turbo_handle()
+    if handle is not None:
+        if grayscale:
+            return handle.encode(
+                array,
+                quality=quality,
+                pixel_format=turbojpeg.TJPF_GRAY,
+                jpeg_subsample=turbojpeg.TJSAMP_GRAY,
             )
+        return handle.encode(
+            array,
+            quality=quality,
+            pixel_format=turbojpeg.TJPF_RGB,
+            jpeg_subsample=turbojpeg.TJSAMP_420,
+        )
+
+    if simplejpeg is None:
+        return None
+    if grayscale:
+        return simplejpeg.encode_jpeg(array, quality=quality, colorspace="GRAY")
+    return simplejpeg.encode_jpeg(
+        array, quality=quality, colorspace="RGB", colorsubsampling="420"
+    )
+
+
+def _turbo_handle():
+    """Return the shared TurboJPEG encoder handle, or None if unavailable.
+
+    The handle wraps the loaded libjpeg-turbo library and is created once;
+    loading can fail even when the Python package is installed (no shared
+    library on the system), in which case the encoder is disabled.
+
+    Returns:
+        turbojpeg.TurboJPEG | None: The encoder handle.
+    """
+    global _turbo_jpeg, turbojpeg  # pylint:disable=global-statement
+    if turbojpeg is None:
+        return None
+    if _turbo_jpeg is None:
+        try:
+            _turbo_jpeg = turbojpeg.TurboJPEG()
+        except (OSError, RuntimeError):
+            turbojpeg = None
+            return None
+    return _turbo_jpeg
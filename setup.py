@@ -1,12 +1,14 @@
 """Setup script for package."""
 import re
+from pathlib import Path
 
 from setuptools import find_packages, setup
 
-match = re.search(r'^VERSION\s*=\s*"(.*)"', open("biopsy/version.py").read(), re.M)
+_VERSION_RE = re.compile(r'^VERSION\s*=\s*"(.*)"', re.M)
+
+match = _VERSION_RE.search(Path("biopsy/version.py").read_text())
 VERSION = match.group(1) if match else "???"
-with open("README.md", "rb") as f:
-    LONG_DESCRIPTION = f.read().decode("utf-8")
+LONG_DESCRIPTION = Path("README.md").read_text(encoding="utf-8")
 
 setup(
     name="biopsy",
@@ -18,7 +20,14 @@ setup(
     url="",
     keywords="",
     packages=find_packages(),
-    install_requires=["lxml", "openslide-python", "Pillow", "tqdm"],
+    install_requires=[
+        "lxml",
+        "numpy",
+        "opencv-python",
+        "openslide-python",
+        "Pillow",
+        "tqdm",
+    ],
     extras_require={
         "dev": [
             "black",
@@ -32,6 +41,7 @@ setup(
             "rope",
             "pytest",
         ],
+        "perf": ["PyTurboJPEG", "simplejpeg", "tiffslide"],
         "test": ["coverage", "pytest", "pytest-cov", "tox"],
     },
     setup_requires=["pytest-runner"],